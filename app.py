@@ -9,16 +9,33 @@ import streamlit as st
 import gdown
 import zipfile
 import subprocess
+import hashlib
+import pickle
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from joblib import Parallel, delayed
+from ner import cached_entities, clear_entity_cache, doc_entities, extract_entities_chunk
 
-# Debugging Info
-st.write("Python version:", os.sys.version)
-st.write("Installed packages:")
-st.write(subprocess.run(["pip", "freeze"], capture_output=True, text=True).stdout)
+# Debugging Info, gathered once a day rather than on every rerun
+@st.cache_data(ttl=86400, show_spinner=False)
+def _debug_env():
+    return os.sys.version, subprocess.run(["pip", "freeze"], capture_output=True, text=True).stdout
 
-# Load model from Google Drive if not present locally
+if st.sidebar.checkbox("Show environment"):
+    python_version, installed_packages = _debug_env()
+    st.write("Python version:", python_version)
+    st.write("Installed packages:")
+    st.write(installed_packages)
+
+MODEL_BASE_DIR = "model/en_ner_bc5cdr_md"
+MODEL_DIR = os.path.join(MODEL_BASE_DIR, "en_ner_bc5cdr_md-0.4.0")
+
+# Load model from Google Drive if not present locally; cached across reruns
+@st.cache_resource(show_spinner="Loading BC5CDR model…")
 def download_and_load_model():
-    base_dir = "model/en_ner_bc5cdr_md"
-    nested_model_dir = os.path.join(base_dir, "en_ner_bc5cdr_md-0.4.0")
+    base_dir = MODEL_BASE_DIR
+    nested_model_dir = MODEL_DIR
     zip_path = os.path.join(base_dir, "en_ner_bc5cdr_md.zip")
     config_path = os.path.join(nested_model_dir, "config.cfg")
     download_url = "https://drive.google.com/uc?id=1kjTjVdmtLJSu7BFWMn2HMiB7eTSdmqhy"
@@ -31,16 +48,32 @@ def download_and_load_model():
         if not os.path.exists(config_path):
             raise FileNotFoundError("Model extraction failed.")
 
-    return spacy.load(nested_model_dir)
+    # Move Thinc ops onto the GPU when CUDA and cupy are available
+    try:
+        import cupy  # noqa: F401
+        spacy.require_gpu()
+        device = "GPU"
+    except Exception:
+        spacy.require_cpu()
+        device = "CPU"
+
+    clear_entity_cache()
+    return spacy.load(nested_model_dir), device
+
+# Only the NER output is consumed; tagger, parser, lemmatizer etc. are skipped
+NER_PIPES = {"tok2vec", "ner"}
 
 # Initialize SpaCy model
 try:
-    nlp = download_and_load_model()
+    nlp, device = download_and_load_model()
     st.success("BIOMEDICAL models loaded successfully.")
+    st.sidebar.caption(f"Entity extraction device: {device}")
 except Exception as e:
     st.error(f"Failed to load model: {e}")
     st.stop()
 
+UNUSED_PIPES = [name for name in nlp.pipe_names if name not in NER_PIPES]
+
 # PubMed Search Functions
 def construct_query(search_term, mesh_term, choice):
     article_types = {
@@ -55,64 +88,181 @@ def construct_query(search_term, mesh_term, choice):
         query += f" AND {mesh_term}[MeSH Terms]"
     return query
 
-def fetch_abstracts(query, num_articles, email):
-    Entrez.email = email
+# NCBI recommends fetching ~200 ids per efetch request
+EFETCH_BATCH_SIZE = 200
+
+# Retry transient NCBI failures quickly instead of Biopython's default 15s back-off
+Entrez.max_tries = 3
+Entrez.sleep_between_tries = 1
+
+# email/api_key are passed per request rather than set on the Entrez module, since
+# concurrent Streamlit sessions share that global state
+def _efetch_medline(id_chunk, email, api_key):
+    handle = Entrez.efetch(db="pubmed", id=",".join(id_chunk), rettype="medline", retmode="text",
+                           email=email, api_key=api_key)
     try:
-        handle = Entrez.esearch(db="pubmed", term=query, retmax=num_articles)
-        result = Entrez.read(handle)
+        return list(Medline.parse(handle))
+    finally:
         handle.close()
-        ids = result['IdList']
-        if not ids:
-            return []
 
-        handle = Entrez.efetch(db="pubmed", id=ids, rettype="medline", retmode="text")
-        records = Medline.parse(handle)
-        articles = list(records)
-        handle.close()
+# Parsed Medline records are cached on disk per (query, num_articles)
+PUBMED_CACHE_DIR = "cache"
+PUBMED_CACHE_TTL = 3600
+
+def _load_cached_articles(cache_path):
+    try:
+        if time.time() - os.path.getmtime(cache_path) > PUBMED_CACHE_TTL:
+            return None
+        with open(cache_path, "rb") as file:
+            return pickle.load(file)
+    except FileNotFoundError:
+        return None
+    except Exception:
+        # A corrupt or truncated file is a miss; drop it so the next fetch rewrites it
+        try:
+            os.remove(cache_path)
+        except OSError:
+            pass
+        return None
+
+# Best effort: a failed write (read-only dir, full disk) must not lose fetched records
+def _store_cached_articles(cache_path, articles):
+    # Write under a unique temp name and swap it in so readers never see a partial file
+    tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(PUBMED_CACHE_DIR, exist_ok=True)
+        with open(tmp_path, "wb") as file:
+            pickle.dump(articles, file)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+# Errors propagate so that failed fetches are never cached
+@st.cache_data(ttl=PUBMED_CACHE_TTL, show_spinner=False)
+def fetch_abstracts(query, num_articles, email, api_key=None):
+    key = hashlib.sha1(f"{query}|{num_articles}".encode()).hexdigest()
+    cache_path = os.path.join(PUBMED_CACHE_DIR, f"{key}.pkl")
+    articles = _load_cached_articles(cache_path)
+    if articles is not None:
         return articles
-    except Exception as e:
-        st.write(f"Error fetching articles: {e}")
+
+    api_key = api_key or None
+    handle = Entrez.esearch(db="pubmed", term=query, retmax=num_articles, email=email, api_key=api_key)
+    result = Entrez.read(handle)
+    handle.close()
+    ids = result['IdList']
+    if not ids:
         return []
 
+    chunks = [ids[i:i + EFETCH_BATCH_SIZE] for i in range(0, len(ids), EFETCH_BATCH_SIZE)]
+    if len(chunks) == 1:
+        articles = _efetch_medline(chunks[0], email, api_key)
+    else:
+        # Stay under NCBI's rate limit: 3 requests/s without an API key, 10/s with one
+        delay = 0.1 if api_key else 0.34
+        articles = []
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            futures = []
+            for i, chunk in enumerate(chunks):
+                if i:
+                    time.sleep(delay)
+                futures.append(executor.submit(_efetch_medline, chunk, email, api_key))
+            for future in futures:
+                articles.extend(future.result())
+
+    _store_cached_articles(cache_path, articles)
+    return articles
+
 def save_to_excel(articles):
     output = BytesIO()
-    data = [{
+    df = pd.DataFrame.from_records(({
         'Title': article.get('TI', 'No title'),
         'Authors': ', '.join(article.get('AU', 'No authors')),
         'Abstract': article.get('AB', 'No abstract'),
         'Publication Date': article.get('DP', 'No date'),
         'Journal': article.get('TA', 'No journal')
-    } for article in articles]
-
-    df = pd.DataFrame(data)
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
+    } for article in articles), columns=['Title', 'Authors', 'Abstract', 'Publication Date', 'Journal'])
+    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
         df.to_excel(writer, index=False)
     output.seek(0)
     return output, df
 
+def save_to_parquet(df):
+    output = BytesIO()
+    df.to_parquet(output, engine='pyarrow', compression='zstd', index=False)
+    output.seek(0)
+    return output
+
 # Entity Extraction and Visualization Functions
 def get_bc5cdr_entities(sent, entity_types):
-    doc = nlp(sent)
-    return [(ent.text.lower(), ent.label_) for ent in doc.ents if ent.label_ in entity_types]
+    doc = nlp(sent, disable=UNUSED_PIPES)
+    return doc_entities(doc, entity_types)
 
-def process_abstracts_from_excel(df, entity_types, allowed_relationships):
-    rows = []
+def extract_entities_parallel(texts, entity_types, batch_size=64):
+    if not texts:
+        return []
+    n_jobs = max(1, (os.cpu_count() or 2) // 2)
+    chunk_size = -(-len(texts) // n_jobs)
+    chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
+    results = Parallel(n_jobs=n_jobs, backend="loky")(
+        delayed(extract_entities_chunk)(MODEL_DIR, chunk, entity_types, UNUSED_PIPES, batch_size)
+        for chunk in chunks
+    )
+    return [entities for chunk_entities in results for entities in chunk_entities]
+
+def process_abstracts_from_excel(df, entity_types, allowed_relationships, batch_size=64, parallel=False):
+    edge_counts = {}
     entity_to_titles = {}
-    for _, row in df[['Abstract', 'Title']].dropna().iterrows():
-        entities = get_bc5cdr_entities(row['Abstract'], entity_types)
+    # Hashable so it can key the entity cache; also O(1) label membership
+    entity_types = frozenset(entity_types)
+    # Relationships are undirected: keep one orientation per label pair, picking
+    # the smaller one when both are given so labels don't depend on set order
+    requested = {tuple(rel) for rel in allowed_relationships if len(rel) == 2}
+    allowed = sorted(rel for rel in requested if not (rel[::-1] in requested and rel[::-1] < rel))
+    abstracts = df['Abstract'].to_numpy()
+    titles = df['Title'].to_numpy()
+    mask = pd.notna(abstracts) & pd.notna(titles)
+    texts = abstracts[mask].tolist()
+    titles = titles[mask].tolist()
+    if parallel:
+        def extract(batch):
+            return extract_entities_parallel(batch, entity_types, batch_size)
+    else:
+        def extract(batch):
+            return [doc_entities(doc, entity_types)
+                    for doc in nlp.pipe(batch, batch_size=batch_size, disable=UNUSED_PIPES)]
+    entity_lists = cached_entities(texts, entity_types, extract)
+    for title, entities in zip(titles, entity_lists):
         for entity_text, entity_type in entities:
             if entity_text not in entity_to_titles:
                 entity_to_titles[entity_text] = {"titles": set(), "type": entity_type}
-            entity_to_titles[entity_text]["titles"].add(row['Title'])
+            entity_to_titles[entity_text]["titles"].add(title)
 
-        for entity1, entity2 in itertools.combinations(entities, 2):
-            if (entity1[1], entity2[1]) in allowed_relationships or (entity2[1], entity1[1]) in allowed_relationships:
-                rows.append({
-                    'source': entity1[0], 'target': entity2[0], 
-                    'edge': f"{entity1[1]}_to_{entity2[1]}"
-                })
+        by_type = {}
+        for entity_text, entity_type in entities:
+            by_type.setdefault(entity_type, []).append(entity_text)
+        for a_lbl, b_lbl in allowed:
+            if a_lbl == b_lbl:
+                pairs_iter = itertools.combinations(by_type.get(a_lbl, ()), 2)
+            else:
+                pairs_iter = itertools.product(by_type.get(a_lbl, ()), by_type.get(b_lbl, ()))
+            edge = f"{a_lbl}_to_{b_lbl}"
+            for a, b in pairs_iter:
+                # Same-label pairs are unordered, so x-y and y-x share one key
+                if a_lbl == b_lbl and b < a:
+                    a, b = b, a
+                key = (a, b, edge)
+                edge_counts[key] = edge_counts.get(key, 0) + 1
 
-    return pd.DataFrame(rows), entity_to_titles
+    sources, targets, edges = (list(col) for col in zip(*edge_counts)) if edge_counts else ([], [], [])
+    kg_df = pd.DataFrame(
+        {'source': sources, 'target': targets, 'edge': edges, 'count': list(edge_counts.values())},
+        copy=False,
+    )
+    return kg_df, entity_to_titles
 
 def visualize_graph_interactive(kg_df, entity_to_titles):
     net = Network(height="100vh", width="100vw", bgcolor="#222222", font_color="white")
@@ -121,21 +271,43 @@ def visualize_graph_interactive(kg_df, entity_to_titles):
         "DISEASE": "red"
     }
 
+    # Node dicts are appended directly, mirroring what add_node stores. add_node
+    # checks membership against a list on every call, and add_nodes just loops
+    # over it after int()-casting number-like ids. Entity texts are already unique
     for entity, details in entity_to_titles.items():
-        color = entity_colors.get(details["type"].upper(), "#999999")
-        title = "<br>".join(details["titles"])
-        net.add_node(entity, title=title, color=color)
+        node = {
+            "id": entity,
+            "label": entity,
+            "shape": "dot",
+            "color": entity_colors.get(details["type"].upper(), "#999999"),
+            "title": "<br>".join(details["titles"]),
+            "font": {"color": net.font_color},
+        }
+        net.nodes.append(node)
+        net.node_ids.append(entity)
+        net.node_map[entity] = node
 
-    for _, row in kg_df.iterrows():
-        if row['source'] in net.get_nodes() and row['target'] in net.get_nodes():
-            net.add_edge(row['source'], row['target'], title=row['edge'])
+    # Edge dicts are appended directly instead of via add_edge, which scans the
+    # node list and existing edges on every call. That means doing add_edge's
+    # checks here: endpoints must be known nodes, and since the graph is
+    # undirected, rows sharing an endpoint pair in either direction are merged
+    # into one edge
+    node_ids = set(entity_to_titles)
+    merged_edges = {}
+    for source, target, edge, count in kg_df[['source', 'target', 'edge', 'count']].itertuples(index=False, name=None):
+        if source not in node_ids or target not in node_ids:
+            continue
+        pair = (source, target) if source <= target else (target, source)
+        if pair in merged_edges:
+            merged = merged_edges[pair]
+            merged["title"] += f"<br>{edge} ({count})"
+            merged["value"] += count
+        else:
+            merged_edges[pair] = {"from": source, "to": target, "title": f"{edge} ({count})", "value": count}
+    net.edges.extend(merged_edges.values())
 
     net.force_atlas_2based(gravity=-60, central_gravity=0.002, spring_length=100, spring_strength=0.01, damping=0.6)
-    html_path = "graph_download.html"
-    net.save_graph(html_path)
-
-    with open(html_path, "r") as file:
-        html_content = file.read()
+    html_content = net.generate_html(notebook=False)
 
     full_page_css = """
     <style>
@@ -143,35 +315,36 @@ def visualize_graph_interactive(kg_df, entity_to_titles):
         #mynetwork { width: 100vw; height: 100vh; }
     </style>
     """
-    html_content = html_content.replace("<head>", f"<head>{full_page_css}")
-
-    with open(html_path, "w") as file:
-        file.write(html_content)
-
-    return html_path
+    return html_content.replace("<head>", f"<head>{full_page_css}")
 
 # Streamlit UI
 st.title("PubMed Research Navigator & Biomedical Entity Visualizer")
 
 if "df" not in st.session_state:
     st.session_state["df"] = None
-if "html_path" not in st.session_state:
-    st.session_state["html_path"] = None
+if "html_content" not in st.session_state:
+    st.session_state["html_content"] = None
 
 email = st.text_input("Enter your email for PubMed access:")
+api_key = st.text_input("Optional NCBI API key:", type="password")
 search_term = st.text_input("Enter search term:")
 mesh_term = st.text_input("Optional MeSH term:")
 article_choice = st.selectbox("Select article type:", ["Clinical Trials", "Meta-Analysis", "Randomized Controlled Trials", "Reviews"])
-num_articles = st.number_input("Number of articles to fetch:", min_value=1, max_value=100, value=10)
+num_articles = st.number_input("Number of articles to fetch:", min_value=1, max_value=1000, value=10)
 
 if st.button("Fetch PubMed Articles"):
     if email and search_term:
         query = construct_query(search_term, mesh_term, article_choice)
-        articles = fetch_abstracts(query, num_articles, email)
+        try:
+            articles = fetch_abstracts(query, num_articles, email, api_key)
+        except Exception as e:
+            st.write(f"Error fetching articles: {e}")
+            articles = []
         if articles:
             excel_data, df = save_to_excel(articles)
             st.session_state["df"] = df
             st.session_state["excel_data"] = excel_data
+            st.session_state["parquet_data"] = save_to_parquet(df)
             st.success("Excel file ready for entity extraction.")
 
 if "excel_data" in st.session_state and st.session_state["excel_data"]:
@@ -182,25 +355,38 @@ if "excel_data" in st.session_state and st.session_state["excel_data"]:
         mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
     )
 
+if "parquet_data" in st.session_state and st.session_state["parquet_data"]:
+    st.download_button(
+        label="Download PubMed Articles as Parquet",
+        data=st.session_state["parquet_data"],
+        file_name="pubmed_articles.parquet",
+        mime="application/vnd.apache.parquet"
+    )
+
 if st.session_state["df"] is not None:
     df = st.session_state["df"]
     entity_types_input = st.text_input("Enter entity types (e.g., CHEMICAL, DISEASE)", "CHEMICAL, DISEASE")
     allowed_rel_input = st.text_input("Enter allowed relationships (e.g., CHEMICAL-DISEASE)")
+    # Worker startup outweighs the gain below roughly 200 abstracts. Workers load
+    # their own CPU model, so the option is off when the main model is on GPU
+    parallel = st.checkbox(
+        "Parallel CPU entity extraction (for 200+ abstracts)",
+        disabled=device == "GPU",
+        help="Unavailable while the model runs on GPU." if device == "GPU" else None,
+    ) and device != "GPU"
 
     if st.button("Process and Generate Graph for Download"):
-        entity_types = [et.strip() for et in entity_types_input.split(",")]
-        allowed_relationships = [tuple(rel.strip().split("-")) for rel in allowed_rel_input.split(",") if "-" in rel]
-        kg_df, entity_to_titles = process_abstracts_from_excel(df, entity_types, allowed_relationships)
-        st.write(f"Processed {len(kg_df)} relationships for visualization.")
-        html_path = visualize_graph_interactive(kg_df, entity_to_titles)
-        st.session_state["html_path"] = html_path
-
-if st.session_state["html_path"]:
-    with open(st.session_state["html_path"], "r") as file:
-        html_content = file.read()
-        st.download_button(
-            label="Download HTML Visualization",
-            data=html_content,
-            file_name="entity_relationship_graph.html",
-            mime="text/html"
-        )
+        # Frozensets give O(1) membership tests in the extraction loop
+        entity_types = frozenset(et.strip() for et in entity_types_input.split(","))
+        allowed_relationships = frozenset(tuple(rel.strip().split("-")) for rel in allowed_rel_input.split(",") if "-" in rel)
+        kg_df, entity_to_titles = process_abstracts_from_excel(df, entity_types, allowed_relationships, parallel=parallel)
+        st.write(f"Processed {len(kg_df)} unique relationships ({int(kg_df['count'].sum())} mentions) for visualization.")
+        st.session_state["html_content"] = visualize_graph_interactive(kg_df, entity_to_titles)
+
+if st.session_state["html_content"]:
+    st.download_button(
+        label="Download HTML Visualization",
+        data=st.session_state["html_content"].encode("utf-8"),
+        file_name="entity_relationship_graph.html",
+        mime="text/html"
+    )
@@ -0,0 +1,54 @@
+import threading
+from collections import OrderedDict
+
+import spacy
+
+# Entity extraction helpers kept free of Streamlit so joblib workers can import them
+
+# Per-worker model, loaded on first use and reused for every chunk the worker receives.
+# Keyed on the load arguments so a reused worker never serves a different pipeline
+_NLP = None
+_NLP_KEY = None
+
+# LRU of extracted entities keyed by (abstract text, entity types); cleared when the
+# model is reloaded. Streamlit sessions run on separate threads, hence the lock
+_ENTITY_CACHE = OrderedDict()
+_ENTITY_CACHE_LOCK = threading.Lock()
+ENTITY_CACHE_SIZE = 4096
+
+def clear_entity_cache():
+    with _ENTITY_CACHE_LOCK:
+        _ENTITY_CACHE.clear()
+
+def cached_entities(texts, entity_types, extract):
+    found = {}
+    with _ENTITY_CACHE_LOCK:
+        for text in texts:
+            key = (text, entity_types)
+            if key in _ENTITY_CACHE:
+                _ENTITY_CACHE.move_to_end(key)
+                found[text] = _ENTITY_CACHE[key]
+    missing = [text for text in dict.fromkeys(texts) if text not in found]
+    if missing:
+        # Misses are extracted in one call so they still go through nlp.pipe in batches
+        extracted = [tuple(entities) for entities in extract(missing)]
+        with _ENTITY_CACHE_LOCK:
+            for text, entities in zip(missing, extracted):
+                found[text] = entities
+                _ENTITY_CACHE[(text, entity_types)] = entities
+                _ENTITY_CACHE.move_to_end((text, entity_types))
+            while len(_ENTITY_CACHE) > ENTITY_CACHE_SIZE:
+                _ENTITY_CACHE.popitem(last=False)
+    return [found[text] for text in texts]
+
+def doc_entities(doc, entity_types):
+    return [(ent.text.lower(), ent.label_) for ent in doc.ents if ent.label_ in entity_types]
+
+def extract_entities_chunk(model_dir, texts, entity_types, exclude, batch_size=64):
+    global _NLP, _NLP_KEY
+    key = (model_dir, tuple(exclude))
+    if _NLP_KEY != key:
+        _NLP = spacy.load(model_dir, exclude=exclude)
+        _NLP_KEY = key
+    # Plain tuples are returned so Doc objects never cross the process boundary
+    return [doc_entities(doc, entity_types) for doc in _NLP.pipe(texts, batch_size=batch_size)]